@@ -1,16 +1,18 @@
 from __future__ import annotations
 
+import asyncio
 import hashlib
 import json
+from contextlib import asynccontextmanager
 from dataclasses import dataclass
 from datetime import datetime, timezone
 from pathlib import Path
-from typing import Any, Optional
+from typing import Any, AsyncIterator, Optional
 
 import aiosqlite
 
 
-@dataclass
+@dataclass(slots=True)
 class InboundStatusEvent:
     id: int
     whapi_event_id: Optional[str]
@@ -31,18 +33,77 @@ class InboundStatusEvent:
     posted_at: Optional[str]
 
 
+_canonical_encoder = json.JSONEncoder(sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+_conn: Optional[aiosqlite.Connection] = None
+_conn_lock = asyncio.Lock()
+_tx_lock = asyncio.Lock()
+
+
 def utc_now() -> str:
     return datetime.now(timezone.utc).isoformat()
 
 
 def payload_hash(payload: dict[str, Any]) -> str:
-    canonical = json.dumps(payload, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
-    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+    return hashlib.sha256(_canonical_encoder.encode(payload).encode("utf-8")).hexdigest()
+
+
+def body_hashes(body: bytes, keys: list[Optional[str]]) -> list[Optional[str]]:
+    base = hashlib.sha256(body)
+    hashes: list[Optional[str]] = []
+    for key in keys:
+        if key is None:
+            hashes.append(None)
+            continue
+        h = base.copy()
+        h.update(b"|")
+        h.update(key.encode("utf-8"))
+        hashes.append(h.hexdigest())
+    return hashes
+
+
+async def get_conn(db_path: Path) -> aiosqlite.Connection:
+    global _conn
+    if _conn is not None:
+        return _conn
+    async with _conn_lock:
+        if _conn is None:
+            conn = await aiosqlite.connect(db_path, isolation_level=None, cached_statements=256)
+            await conn.execute("PRAGMA synchronous=NORMAL")
+            await conn.execute("PRAGMA busy_timeout=5000")
+            await conn.execute("PRAGMA cache_size=-20000")
+            await conn.execute("PRAGMA wal_autocheckpoint=1000")
+            await conn.execute("PRAGMA temp_store=MEMORY")
+            await conn.execute("PRAGMA mmap_size=268435456")
+            await conn.execute("PRAGMA foreign_keys = ON")
+            _conn = conn
+    return _conn
+
+
+async def close_db() -> None:
+    global _conn
+    async with _conn_lock:
+        if _conn is not None:
+            await _conn.close()
+            _conn = None
+
+
+@asynccontextmanager
+async def _transaction(db: aiosqlite.Connection) -> AsyncIterator[None]:
+    async with _tx_lock:
+        await db.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            await db.execute("ROLLBACK")
+            raise
+        await db.execute("COMMIT")
 
 
 async def init_db(db_path: Path) -> None:
     db_path.parent.mkdir(parents=True, exist_ok=True)
-    async with aiosqlite.connect(db_path) as db:
+    db = await get_conn(db_path)
+    await db.execute("PRAGMA journal_mode=WAL")
+    async with _transaction(db):
         await db.execute(
             """
             CREATE TABLE IF NOT EXISTS inbound_status_events (
@@ -66,10 +127,61 @@ async def init_db(db_path: Path) -> None:
             )
             """
         )
+        await db.execute("DROP INDEX IF EXISTS idx_inbound_state_next")
+        await db.execute("DROP INDEX IF EXISTS idx_inbound_received")
         await db.execute(
-            "CREATE INDEX IF NOT EXISTS idx_inbound_state_next ON inbound_status_events(state, next_attempt_at)"
+            """
+            CREATE INDEX IF NOT EXISTS idx_inbound_pending
+            ON inbound_status_events(received_at, attempts, next_attempt_at)
+            WHERE state IN ('queued', 'failed')
+            """
         )
-        await db.commit()
+
+
+_EVENT_COLUMNS = """
+    id, whapi_event_id, source_status_id, received_at, payload_hash, media_type,
+    media_remote_id, media_url, caption, state, attempts, last_error, target_status_id,
+    stored_original_path, stored_prepared_path, next_attempt_at, posted_at
+"""
+
+_INSERT_EVENT_SQL = """
+    INSERT OR IGNORE INTO inbound_status_events (
+        whapi_event_id,
+        source_status_id,
+        payload_hash,
+        media_type,
+        media_remote_id,
+        media_url,
+        caption,
+        received_at,
+        state,
+        attempts
+    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, 'queued', 0)
+"""
+
+_INSERT_EVENT_RETURNING_SQL = _INSERT_EVENT_SQL + " RETURNING id"
+
+_CLAIM_EVENTS_SQL = f"""
+    UPDATE inbound_status_events
+    SET state = 'processing',
+        attempts = attempts + 1
+    WHERE id IN (
+        SELECT id
+        FROM inbound_status_events
+        WHERE state IN ('queued', 'failed')
+          AND attempts < ?
+          AND (next_attempt_at IS NULL OR next_attempt_at <= ?)
+        ORDER BY received_at ASC
+        LIMIT ?
+    )
+    RETURNING {_EVENT_COLUMNS}
+"""
+
+_GET_EVENT_SQL = f"""
+    SELECT {_EVENT_COLUMNS}
+    FROM inbound_status_events
+    WHERE id = ?
+"""
 
 
 async def insert_event(
@@ -83,92 +195,45 @@ async def insert_event(
     media_url: Optional[str],
     caption: Optional[str],
 ) -> Optional[int]:
-    async with aiosqlite.connect(db_path) as db:
-        await db.execute("PRAGMA foreign_keys = ON")
+    db = await get_conn(db_path)
+    async with _tx_lock:
         cursor = await db.execute(
-            """
-            INSERT OR IGNORE INTO inbound_status_events (
-                whapi_event_id,
-                source_status_id,
-                received_at,
-                payload_hash,
-                media_type,
-                media_remote_id,
-                media_url,
-                caption,
-                state,
-                attempts
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, 'queued', 0)
-            """,
+            _INSERT_EVENT_RETURNING_SQL,
             (
                 whapi_event_id,
                 source_status_id,
-                utc_now(),
                 payload_hash_value,
                 media_type,
                 media_remote_id,
                 media_url,
                 caption,
+                utc_now(),
             ),
         )
-        await db.commit()
-        if cursor.rowcount == 0:
-            return None
-        return cursor.lastrowid
+        rows = await cursor.fetchall()
+    return rows[0][0] if rows else None
 
 
-async def fetch_next_event(db_path: Path, *, now: str, max_attempts: int) -> Optional[InboundStatusEvent]:
-    async with aiosqlite.connect(db_path) as db:
-        await db.execute("BEGIN IMMEDIATE")
-        cursor = await db.execute(
-            """
-            SELECT id, whapi_event_id, source_status_id, received_at, payload_hash, media_type,
-                   media_remote_id, media_url, caption, state, attempts, last_error, target_status_id,
-                   stored_original_path, stored_prepared_path, next_attempt_at, posted_at
-            FROM inbound_status_events
-            WHERE state IN ('queued', 'failed')
-              AND attempts < ?
-              AND (next_attempt_at IS NULL OR next_attempt_at <= ?)
-            ORDER BY received_at ASC
-            LIMIT 1
-            """,
-            (max_attempts, now),
-        )
-        row = await cursor.fetchone()
-        if not row:
-            await db.execute("COMMIT")
-            return None
-        await db.execute(
-            """
-            UPDATE inbound_status_events
-            SET state = 'processing',
-                attempts = attempts + 1
-            WHERE id = ?
-            """,
-            (row[0],),
-        )
-        await db.execute("COMMIT")
-        return InboundStatusEvent(*row)
+async def insert_events_bulk(db_path: Path, rows: list[tuple[Any, ...]]) -> int:
+    if not rows:
+        return 0
+    received_at = utc_now()
+    db = await get_conn(db_path)
+    async with _transaction(db):
+        cursor = await db.executemany(_INSERT_EVENT_SQL, [(*row, received_at) for row in rows])
+    return max(cursor.rowcount, 0)
 
 
-async def mark_processing_paths(
-    db_path: Path,
-    *,
-    event_id: int,
-    stored_original_path: Optional[str],
-    stored_prepared_path: Optional[str],
-) -> None:
-    async with aiosqlite.connect(db_path) as db:
-        await db.execute(
-            """
-            UPDATE inbound_status_events
-            SET stored_original_path = ?,
-                stored_prepared_path = ?
-            WHERE id = ?
-            """,
-            (stored_original_path, stored_prepared_path, event_id),
-        )
-        await db.commit()
+async def fetch_next_events(
+    db_path: Path, *, now: str, max_attempts: int, limit: int = 8
+) -> list[InboundStatusEvent]:
+    db = await get_conn(db_path)
+    async with _tx_lock:
+        cursor = await db.execute(_CLAIM_EVENTS_SQL, (max_attempts, now, limit))
+        rows = await cursor.fetchall()
+    events = [InboundStatusEvent(*row) for row in rows]
+    events.sort(key=lambda event: (event.received_at, event.id))
+    return events
 
 
 async def mark_posted(
@@ -176,20 +241,24 @@ async def mark_posted(
     *,
     event_id: int,
     target_status_id: Optional[str],
+    stored_original_path: Optional[str] = None,
+    stored_prepared_path: Optional[str] = None,
 ) -> None:
-    async with aiosqlite.connect(db_path) as db:
+    db = await get_conn(db_path)
+    async with _tx_lock:
         await db.execute(
             """
             UPDATE inbound_status_events
             SET state = 'posted',
                 target_status_id = ?,
                 posted_at = ?,
-                last_error = NULL
+                last_error = NULL,
+                stored_original_path = COALESCE(?, stored_original_path),
+                stored_prepared_path = COALESCE(?, stored_prepared_path)
             WHERE id = ?
             """,
-            (target_status_id, utc_now(), event_id),
+            (target_status_id, utc_now(), stored_original_path, stored_prepared_path, event_id),
         )
-        await db.commit()
 
 
 async def mark_failed(
@@ -198,34 +267,29 @@ async def mark_failed(
     event_id: int,
     error_message: str,
     next_attempt_at: Optional[str],
+    stored_original_path: Optional[str] = None,
+    stored_prepared_path: Optional[str] = None,
 ) -> None:
-    async with aiosqlite.connect(db_path) as db:
+    db = await get_conn(db_path)
+    async with _tx_lock:
         await db.execute(
             """
             UPDATE inbound_status_events
             SET state = 'failed',
                 last_error = ?,
-                next_attempt_at = ?
+                next_attempt_at = ?,
+                stored_original_path = COALESCE(?, stored_original_path),
+                stored_prepared_path = COALESCE(?, stored_prepared_path)
             WHERE id = ?
             """,
-            (error_message, next_attempt_at, event_id),
+            (error_message, next_attempt_at, stored_original_path, stored_prepared_path, event_id),
         )
-        await db.commit()
 
 
 async def get_event(db_path: Path, event_id: int) -> Optional[InboundStatusEvent]:
-    async with aiosqlite.connect(db_path) as db:
-        cursor = await db.execute(
-            """
-            SELECT id, whapi_event_id, source_status_id, received_at, payload_hash, media_type,
-                   media_remote_id, media_url, caption, state, attempts, last_error, target_status_id,
-                   stored_original_path, stored_prepared_path, next_attempt_at, posted_at
-            FROM inbound_status_events
-            WHERE id = ?
-            """,
-            (event_id,),
-        )
-        row = await cursor.fetchone()
-        if not row:
-            return None
-        return InboundStatusEvent(*row)
+    db = await get_conn(db_path)
+    cursor = await db.execute(_GET_EVENT_SQL, (event_id,))
+    row = await cursor.fetchone()
+    if not row:
+        return None
+    return InboundStatusEvent(*row)
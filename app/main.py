@@ -1,11 +1,11 @@
 from __future__ import annotations
 
-import json
 import logging
 from contextlib import asynccontextmanager
 from typing import Any
 
-from fastapi import FastAPI, HTTPException, Request
+import orjson
+from fastapi import Depends, FastAPI, HTTPException, Request
 
 from app import db
 from app.settings import Settings, get_settings
@@ -24,55 +24,66 @@ def configure_logging(settings: Settings) -> None:
 async def lifespan(app: FastAPI):
     settings = get_settings()
     configure_logging(settings)
-    await db.init_db(settings.db_path)
-    worker = Worker(settings)
-    await worker.start()
-    app.state.worker = worker
-    yield
-    await worker.stop()
+    app.state.settings = settings
+    app.state.webhook_secret = settings.webhook_secret.encode("utf-8")
+    try:
+        await db.init_db(settings.db_path)
+        worker = Worker(settings)
+        await worker.start()
+        app.state.worker = worker
+        try:
+            yield
+        finally:
+            await worker.stop()
+    finally:
+        await db.close_db()
 
 
 app = FastAPI(lifespan=lifespan)
 
 
+def app_settings(request: Request) -> Settings:
+    return request.app.state.settings
+
+
 @app.post("/webhook/whapi")
-async def whapi_webhook(request: Request) -> dict[str, Any]:
-    settings = get_settings()
+async def whapi_webhook(request: Request, settings: Settings = Depends(app_settings)) -> dict[str, Any]:
     body = await request.body()
-    signature = request.headers.get("X-Whapi-Signature")
-    provided_secret = request.headers.get("X-Webhook-Secret") or request.query_params.get("secret")
+    headers = request.headers
+    signature = headers.get("X-Whapi-Signature")
+    provided_secret = headers.get("X-Webhook-Secret") or request.query_params.get("secret")
 
     if not verify_webhook(
         body=body,
-        secret=settings.webhook_secret,
+        secret=request.app.state.webhook_secret,
         signature_header=signature,
         provided_secret=provided_secret,
     ):
         raise HTTPException(status_code=401, detail="Invalid webhook signature")
 
     try:
-        payload = json.loads(body.decode("utf-8"))
-    except json.JSONDecodeError as exc:
+        payload = orjson.loads(body)
+    except orjson.JSONDecodeError as exc:
         raise HTTPException(status_code=400, detail="Invalid JSON") from exc
 
     events = extract_status_events(payload)
     if not events:
         return {"status": "ignored"}
 
-    inserted = 0
-    for event in events:
-        event_payload = {"event": event.raw_event, "source_status_id": event.source_status_id}
-        payload_hash_value = db.payload_hash(event_payload)
-        row_id = await db.insert_event(
-            settings.db_path,
-            whapi_event_id=event.whapi_event_id,
-            source_status_id=event.source_status_id,
-            payload_hash_value=payload_hash_value,
-            media_type=event.media_type,
-            media_remote_id=event.media_remote_id,
-            media_url=event.media_url,
-            caption=event.caption,
+    hashes = db.body_hashes(body, [event.source_status_id for event in events])
+    rows = [
+        (
+            event.whapi_event_id,
+            event.source_status_id,
+            body_hash or db.payload_hash({"event": event.raw_event, "source_status_id": None}),
+            event.media_type,
+            event.media_remote_id,
+            event.media_url,
+            event.caption,
         )
-        if row_id:
-            inserted += 1
+        for event, body_hash in zip(events, hashes)
+    ]
+    inserted = await db.insert_events_bulk(settings.db_path, rows)
+    if inserted:
+        request.app.state.worker.wakeup.set()
     return {"status": "accepted", "inserted": inserted}
@@ -1,9 +1,18 @@
 from __future__ import annotations
 
+import asyncio
+import hashlib
+import json
 import logging
 import mimetypes
+import os
+import shutil
 import subprocess
+import time
+import uuid
+from concurrent.futures import Executor
 from datetime import datetime, timedelta, timezone
+from functools import lru_cache
 from pathlib import Path
 from typing import Optional
 
@@ -15,9 +24,35 @@ from app.whapi_client import WhapiClient, WhapiError
 
 logger = logging.getLogger(__name__)
 
+_X264_PRESET = "superfast"
+_X264_CRF = "22"
+_H264_ENCODER_ARGS = {
+    "h264_nvenc": ["-c:v", "h264_nvenc", "-profile:v", "high", "-preset", "p4", "-rc", "vbr", "-cq", "23"],
+    "h264_qsv": ["-c:v", "h264_qsv", "-profile:v", "high", "-preset", "faster", "-global_quality", "23"],
+    "h264_videotoolbox": ["-c:v", "h264_videotoolbox", "-profile:v", "high", "-q:v", "50"],
+    "libx264": [
+        "-c:v",
+        "libx264",
+        "-profile:v",
+        "high",
+        "-preset",
+        _X264_PRESET,
+        "-crf",
+        _X264_CRF,
+    ],
+}
+_resolved_h264_encoder: Optional[str] = None
+_encoder_lock = asyncio.Lock()
+_PHOTO_RECIPE = "photo:1080x1920:jpeg92"
+
 
 def _extension_from_content_type(content_type: str) -> str:
-    ext = mimetypes.guess_extension(content_type.split(";")[0].strip())
+    return _extension_for_mime(content_type.split(";", 1)[0].strip().lower())
+
+
+@lru_cache(maxsize=64)
+def _extension_for_mime(mime_type: str) -> str:
+    ext = mimetypes.guess_extension(mime_type)
     if not ext:
         return ".bin"
     return ext
@@ -29,12 +64,81 @@ def _sanitize_caption(caption: Optional[str]) -> Optional[str]:
     return caption.strip() or None
 
 
-def _ensure_dirs(settings: Settings) -> tuple[Path, Path]:
-    original_dir = settings.storage_dir / "original"
-    prepared_dir = settings.storage_dir / "prepared"
-    original_dir.mkdir(parents=True, exist_ok=True)
-    prepared_dir.mkdir(parents=True, exist_ok=True)
-    return original_dir, prepared_dir
+def _storage_dirs(settings: Settings) -> tuple[Path, Path, Path]:
+    return settings.storage_dir / "original", settings.storage_dir / "prepared", settings.storage_dir / "cache"
+
+
+def ensure_storage_dirs(settings: Settings) -> None:
+    for directory in _storage_dirs(settings):
+        directory.mkdir(parents=True, exist_ok=True)
+
+
+def _encoder_args(encoder: str, concurrency: int) -> list[str]:
+    args = list(_H264_ENCODER_ARGS[encoder])
+    if encoder == "libx264":
+        args += ["-threads", str(max(1, (os.cpu_count() or 1) // max(1, concurrency)))]
+    return args
+
+
+def _video_recipe(encoder_args: list[str]) -> str:
+    return "video:1080x1920:30:" + " ".join(encoder_args)
+
+
+def _cache_key(content_digest: str, recipe: str) -> str:
+    return hashlib.sha256(f"{content_digest}|{recipe}".encode("utf-8")).hexdigest()
+
+
+def _staging_path(dest: Path) -> Path:
+    return dest.with_name(f"{dest.stem}.part{dest.suffix}")
+
+
+def _link_file(source: Path, dest: Path) -> None:
+    temp_path = dest.with_name(f".{dest.name}.{uuid.uuid4().hex}")
+    try:
+        try:
+            os.link(source, temp_path)
+        except OSError:
+            shutil.copyfile(source, temp_path)
+        os.replace(temp_path, dest)
+    except BaseException:
+        temp_path.unlink(missing_ok=True)
+        raise
+
+
+def _fill_cache(prepared_path: Path, cached_path: Path) -> None:
+    if cached_path.exists():
+        return
+    _link_file(prepared_path, cached_path)
+
+
+def _link_cached(cached_path: Path, dest: Path) -> bool:
+    try:
+        os.utime(cached_path)
+        _link_file(cached_path, dest)
+    except FileNotFoundError:
+        return False
+    return True
+
+
+def _prune_cache_dir(cache_dir: Path, max_age_s: int) -> int:
+    cutoff = time.time() - max_age_s
+    removed = 0
+    with os.scandir(cache_dir) as entries:
+        for entry in entries:
+            try:
+                if entry.is_file() and entry.stat().st_mtime < cutoff:
+                    os.unlink(entry.path)
+                    removed += 1
+            except FileNotFoundError:
+                continue
+    return removed
+
+
+async def prune_prepared_cache(settings: Settings) -> None:
+    cache_dir = _storage_dirs(settings)[2]
+    removed = await asyncio.to_thread(_prune_cache_dir, cache_dir, settings.prepared_cache_ttl_s)
+    if removed:
+        logger.info("cache.pruned", extra={"removed": removed})
 
 
 def _next_attempt(attempts: int) -> Optional[str]:
@@ -46,39 +150,49 @@ def _next_attempt(attempts: int) -> Optional[str]:
     return (datetime.now(timezone.utc) + timedelta(seconds=backoff[attempts - 1])).isoformat()
 
 
-def _probe_video(path: Path) -> dict[str, str]:
+async def _probe_video(path: Path) -> dict[str, str]:
     try:
-        result = subprocess.run(
-            [
-                "ffprobe",
-                "-v",
-                "error",
-                "-select_streams",
-                "v:0",
-                "-show_entries",
-                "stream=codec_name,width,height,pix_fmt,avg_frame_rate",
-                "-of",
-                "default=noprint_wrappers=1:nokey=1",
-                str(path),
-            ],
-            check=True,
-            capture_output=True,
-            text=True,
+        process = await asyncio.create_subprocess_exec(
+            "ffprobe",
+            "-v",
+            "error",
+            "-print_format",
+            "json",
+            "-show_entries",
+            "stream=codec_type,codec_name,width,height,pix_fmt,avg_frame_rate:format=format_name",
+            str(path),
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL,
         )
     except FileNotFoundError:
         return {}
-    except subprocess.CalledProcessError:
+    stdout, _ = await process.communicate()
+    if process.returncode != 0:
         return {}
-    lines = [line.strip() for line in result.stdout.splitlines() if line.strip()]
-    if len(lines) < 5:
+    try:
+        data = json.loads(stdout)
+    except json.JSONDecodeError:
         return {}
-    return {
-        "codec": lines[0],
-        "width": lines[1],
-        "height": lines[2],
-        "pix_fmt": lines[3],
-        "fps": lines[4],
+    streams = data.get("streams", [])
+    video = next((stream for stream in streams if stream.get("codec_type") == "video"), None)
+    if video is None:
+        return {}
+    probe = {
+        "codec": str(video.get("codec_name", "")),
+        "width": str(video.get("width", "")),
+        "height": str(video.get("height", "")),
+        "pix_fmt": str(video.get("pix_fmt", "")),
+        "fps": str(video.get("avg_frame_rate", "")),
+        "format": str(data.get("format", {}).get("format_name", "")),
     }
+    audio = next((stream for stream in streams if stream.get("codec_type") == "audio"), None)
+    if audio is not None:
+        probe["audio_codec"] = str(audio.get("codec_name", ""))
+    return probe
+
+
+def _video_needs_resize(probe: dict[str, str]) -> bool:
+    return probe.get("width") != "1080" or probe.get("height") != "1920"
 
 
 def _video_needs_reencode(probe: dict[str, str]) -> bool:
@@ -88,100 +202,220 @@ def _video_needs_reencode(probe: dict[str, str]) -> bool:
         return True
     if probe.get("pix_fmt") != "yuv420p":
         return True
-    if probe.get("width") != "1080" or probe.get("height") != "1920":
+    if _video_needs_resize(probe):
         return True
     return False
 
 
-def _has_audio(path: Path) -> bool:
+def _video_needs_remux(probe: dict[str, str]) -> bool:
+    if "mp4" not in probe.get("format", "").split(","):
+        return True
+    return probe.get("audio_codec", "aac") != "aac"
+
+
+def _audio_args(probe: dict[str, str]) -> list[str]:
+    if "audio_codec" not in probe:
+        return ["-an"]
+    if probe["audio_codec"] == "aac":
+        return ["-c:a", "copy"]
+    return ["-c:a", "aac", "-b:a", "128k"]
+
+
+async def _run_ffmpeg(command: list[str]) -> None:
+    process = await asyncio.create_subprocess_exec(*command, stdout=asyncio.subprocess.DEVNULL)
+    returncode = await process.wait()
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, command)
+
+
+async def _encoder_works(encoder: str) -> bool:
     try:
-        result = subprocess.run(
-            [
-                "ffprobe",
-                "-v",
-                "error",
-                "-select_streams",
-                "a:0",
-                "-show_entries",
-                "stream=codec_name",
-                "-of",
-                "default=noprint_wrappers=1:nokey=1",
-                str(path),
-            ],
-            check=True,
-            capture_output=True,
-            text=True,
+        process = await asyncio.create_subprocess_exec(
+            "ffmpeg",
+            "-hide_banner",
+            "-loglevel",
+            "error",
+            "-f",
+            "lavfi",
+            "-i",
+            "color=size=256x256:duration=0.1",
+            *_H264_ENCODER_ARGS[encoder],
+            "-f",
+            "null",
+            "-",
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.DEVNULL,
         )
-    except (FileNotFoundError, subprocess.CalledProcessError):
+    except FileNotFoundError:
         return False
-    return bool(result.stdout.strip())
+    return await process.wait() == 0
+
+
+async def _h264_encoder(preference: str) -> str:
+    global _resolved_h264_encoder
+    if preference != "auto":
+        return preference if preference in _H264_ENCODER_ARGS else "libx264"
+    if _resolved_h264_encoder is not None:
+        return _resolved_h264_encoder
+    async with _encoder_lock:
+        if _resolved_h264_encoder is None:
+            encoder = "libx264"
+            for candidate in ("h264_nvenc", "h264_qsv", "h264_videotoolbox"):
+                if await _encoder_works(candidate):
+                    encoder = candidate
+                    break
+            logger.info("video.encoder", extra={"encoder": encoder})
+            _resolved_h264_encoder = encoder
+    return _resolved_h264_encoder
+
+
+async def warm_up_encoder(settings: Settings) -> None:
+    encoder = await _h264_encoder(settings.h264_encoder)
+    if settings.h264_encoder != "auto" or encoder == "libx264":
+        await _encoder_works(encoder)
 
 
 def _prepare_image(source: Path, dest: Path) -> None:
     with Image.open(source) as img:
+        if (
+            img.format == "JPEG"
+            and img.mode == "RGB"
+            and img.size == (1080, 1920)
+            and img.getexif().get(0x0112, 1) == 1
+        ):
+            _link_file(source, dest)
+            return
+        scale = min(1080 / img.width, 1920 / img.height)
+        img.draft("RGB", (max(1, int(img.width * scale)), max(1, int(img.height * scale))))
         img = img.convert("RGB")
-        fitted = ImageOps.contain(img, (1080, 1920))
+        fitted = ImageOps.contain(img, (1080, 1920), Image.Resampling.BILINEAR)
         canvas = Image.new("RGB", (1080, 1920), color=(0, 0, 0))
         offset = ((1080 - fitted.width) // 2, (1920 - fitted.height) // 2)
         canvas.paste(fitted, offset)
         canvas.save(dest, format="JPEG", quality=92)
 
 
-def _prepare_video(source: Path, dest: Path) -> None:
-    audio_args = ["-c:a", "aac", "-b:a", "128k"] if _has_audio(source) else ["-an"]
+async def _prepare_video(source: Path, dest: Path, probe: dict[str, str], encoder_args: list[str]) -> None:
+    filter_args: list[str] = []
+    if _video_needs_resize(probe):
+        filter_args = [
+            "-vf",
+            "scale=1080:1920:force_original_aspect_ratio=decrease:flags=bilinear,pad=1080:1920:(ow-iw)/2:(oh-ih)/2,setsar=1",
+        ]
     command = [
         "ffmpeg",
         "-y",
         "-i",
         str(source),
-        "-vf",
-        "scale=1080:1920:force_original_aspect_ratio=decrease,pad=1080:1920:(ow-iw)/2:(oh-ih)/2,setsar=1",
-        "-c:v",
-        "libx264",
-        "-profile:v",
-        "high",
+        *filter_args,
+        *encoder_args,
         "-pix_fmt",
         "yuv420p",
-        "-preset",
-        "fast",
         "-r",
         "30",
         "-movflags",
         "+faststart",
-        *audio_args,
+        *_audio_args(probe),
+        str(dest),
+    ]
+    await _run_ffmpeg(command)
+
+
+async def _remux_video(source: Path, dest: Path, probe: dict[str, str]) -> None:
+    command = [
+        "ffmpeg",
+        "-y",
+        "-i",
+        str(source),
+        "-map",
+        "0:v:0",
+        "-map",
+        "0:a:0?",
+        "-c:v",
+        "copy",
+        *_audio_args(probe),
+        "-movflags",
+        "+faststart",
         str(dest),
     ]
-    subprocess.run(command, check=True)
+    await _run_ffmpeg(command)
 
 
-async def process_event(settings: Settings, event: db.InboundStatusEvent) -> None:
-    original_dir, prepared_dir = _ensure_dirs(settings)
-    source_client = WhapiClient(settings.whapi_api_url, settings.whapi_source_token)
-    target_client = WhapiClient(settings.whapi_api_url, settings.whapi_target_token)
+async def _prepare_media(
+    settings: Settings,
+    event: db.InboundStatusEvent,
+    original_path: Path,
+    content_digest: str,
+    executor: Optional[Executor],
+) -> Path:
+    _, prepared_dir, cache_dir = _storage_dirs(settings)
+    if event.media_type == "photo":
+        prepared_path = prepared_dir / f"event_{event.id}.jpg"
+        cached_path = cache_dir / f"{_cache_key(content_digest, _PHOTO_RECIPE)}.jpg"
+        if await asyncio.to_thread(_link_cached, cached_path, prepared_path):
+            return prepared_path
+        staging_path = _staging_path(prepared_path)
+        await asyncio.to_thread(staging_path.unlink, missing_ok=True)
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(executor, _prepare_image, original_path, staging_path)
+        await asyncio.to_thread(os.replace, staging_path, prepared_path)
+        await asyncio.to_thread(_fill_cache, prepared_path, cached_path)
+        return prepared_path
+    if event.media_type == "video":
+        prepared_path = prepared_dir / f"event_{event.id}.mp4"
+        encoder = await _h264_encoder(settings.h264_encoder)
+        encoder_args = _encoder_args(encoder, settings.worker_concurrency)
+        cached_path = cache_dir / f"{_cache_key(content_digest, _video_recipe(encoder_args))}.mp4"
+        if await asyncio.to_thread(_link_cached, cached_path, prepared_path):
+            return prepared_path
+        probe = await _probe_video(original_path)
+        staging_path = _staging_path(prepared_path)
+        await asyncio.to_thread(staging_path.unlink, missing_ok=True)
+        if _video_needs_reencode(probe):
+            await _prepare_video(original_path, staging_path, probe, encoder_args)
+        elif _video_needs_remux(probe):
+            await _remux_video(original_path, staging_path, probe)
+        else:
+            return original_path
+        await asyncio.to_thread(os.replace, staging_path, prepared_path)
+        await asyncio.to_thread(_fill_cache, prepared_path, cached_path)
+        return prepared_path
+    return original_path
+
+
+async def process_event(
+    settings: Settings,
+    event: db.InboundStatusEvent,
+    *,
+    source_client: WhapiClient,
+    target_client: WhapiClient,
+    executor: Optional[Executor] = None,
+) -> None:
+    original_dir = _storage_dirs(settings)[0]
+    stored_original_path: Optional[str] = None
+    stored_prepared_path: Optional[str] = None
 
     try:
-        content, content_type = await source_client.download_media(
-            media_url=event.media_url, media_id=event.media_remote_id
-        )
-        extension = _extension_from_content_type(content_type)
-        original_path = original_dir / f"event_{event.id}{extension}"
-        original_path.write_bytes(content)
-
-        prepared_path = original_path
-        if event.media_type == "photo":
-            prepared_path = prepared_dir / f"event_{event.id}.jpg"
-            _prepare_image(original_path, prepared_path)
-        elif event.media_type == "video":
-            probe = _probe_video(original_path)
-            if _video_needs_reencode(probe):
-                prepared_path = prepared_dir / f"event_{event.id}.mp4"
-                _prepare_video(original_path, prepared_path)
-        await db.mark_processing_paths(
-            settings.db_path,
-            event_id=event.id,
-            stored_original_path=str(original_path),
-            stored_prepared_path=str(prepared_path),
-        )
+        if (
+            event.stored_original_path
+            and event.stored_prepared_path
+            and await asyncio.to_thread(Path(event.stored_prepared_path).is_file)
+        ):
+            original_path = Path(event.stored_original_path)
+            prepared_path = Path(event.stored_prepared_path)
+        else:
+            download_path = original_dir / f"event_{event.id}.part"
+            digest = hashlib.sha256()
+            content_type = await source_client.download_media(
+                media_url=event.media_url, media_id=event.media_remote_id, dest=download_path, digest=digest
+            )
+            extension = _extension_from_content_type(content_type)
+            original_path = await asyncio.to_thread(
+                download_path.replace, original_dir / f"event_{event.id}{extension}"
+            )
+            prepared_path = await _prepare_media(settings, event, original_path, digest.hexdigest(), executor)
+        stored_original_path = str(original_path)
+        stored_prepared_path = str(prepared_path)
 
         media_id = await target_client.upload_media(prepared_path)
         target_status_id = await target_client.post_status(
@@ -189,14 +423,34 @@ async def process_event(settings: Settings, event: db.InboundStatusEvent) -> Non
             media_type=event.media_type,
             caption=_sanitize_caption(event.caption),
         )
-        await db.mark_posted(settings.db_path, event_id=event.id, target_status_id=target_status_id)
+        await db.mark_posted(
+            settings.db_path,
+            event_id=event.id,
+            target_status_id=target_status_id,
+            stored_original_path=stored_original_path,
+            stored_prepared_path=stored_prepared_path,
+        )
         logger.info("status.posted", extra={"event_id": event.id, "target_status_id": target_status_id})
     except (WhapiError, subprocess.CalledProcessError, OSError) as exc:
         logger.exception("status.failed", extra={"event_id": event.id})
-        next_attempt = _next_attempt(event.attempts + 1)
-        await db.mark_failed(settings.db_path, event_id=event.id, error_message=str(exc), next_attempt_at=next_attempt)
+        next_attempt = _next_attempt(event.attempts)
+        await db.mark_failed(
+            settings.db_path,
+            event_id=event.id,
+            error_message=str(exc),
+            next_attempt_at=next_attempt,
+            stored_original_path=stored_original_path,
+            stored_prepared_path=stored_prepared_path,
+        )
     except Exception as exc:  # noqa: BLE001
         logger.exception("status.failed.unexpected", extra={"event_id": event.id})
-        next_attempt = _next_attempt(event.attempts + 1)
-        await db.mark_failed(settings.db_path, event_id=event.id, error_message=str(exc), next_attempt_at=next_attempt)
+        next_attempt = _next_attempt(event.attempts)
+        await db.mark_failed(
+            settings.db_path,
+            event_id=event.id,
+            error_message=str(exc),
+            next_attempt_at=next_attempt,
+            stored_original_path=stored_original_path,
+            stored_prepared_path=stored_prepared_path,
+        )
         raise
@@ -4,6 +4,7 @@ import asyncio
 import json
 
 from app import db
+from app.processor import ensure_storage_dirs
 from app.settings import get_settings
 from app.webhook import extract_status_events
 
@@ -11,9 +12,7 @@ from app.webhook import extract_status_events
 async def run() -> None:
     settings = get_settings()
     await db.init_db(settings.db_path)
-    settings.storage_dir.mkdir(parents=True, exist_ok=True)
-    (settings.storage_dir / "original").mkdir(parents=True, exist_ok=True)
-    (settings.storage_dir / "prepared").mkdir(parents=True, exist_ok=True)
+    ensure_storage_dirs(settings)
 
     sample_payload = {
         "event_id": "sample-event-1",
@@ -49,8 +48,15 @@ async def run() -> None:
     print(json.dumps({"status": "ok", "row_id": row_id}))
 
 
+async def _run_and_close() -> None:
+    try:
+        await run()
+    finally:
+        await db.close_db()
+
+
 def main() -> None:
-    asyncio.run(run())
+    asyncio.run(_run_and_close())
 
 
 if __name__ == "__main__":
@@ -21,6 +21,10 @@ class Settings(BaseSettings):
     log_level: str = Field(default="INFO", alias="LOG_LEVEL")
     poll_interval_s: int = Field(default=10, alias="POLL_INTERVAL_S")
     max_attempts: int = Field(default=8, alias="MAX_ATTEMPTS")
+    fetch_batch_size: int = Field(default=8, ge=1, alias="FETCH_BATCH_SIZE")
+    worker_concurrency: int = Field(default=4, ge=1, alias="WORKER_CONCURRENCY")
+    h264_encoder: str = Field(default="auto", alias="H264_ENCODER")
+    prepared_cache_ttl_s: int = Field(default=604800, alias="PREPARED_CACHE_TTL_S")
 
 
 @lru_cache
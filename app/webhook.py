@@ -20,17 +20,21 @@ class WebhookStatusEvent:
 def verify_webhook(
     *,
     body: bytes,
-    secret: str,
+    secret: bytes,
     signature_header: Optional[str],
     provided_secret: Optional[str],
 ) -> bool:
     if signature_header:
-        expected = hmac.new(secret.encode("utf-8"), body, hashlib.sha256).hexdigest()
-        provided = signature_header
-        if provided.startswith("sha256="):
-            provided = provided.split("=", 1)[1]
-        return hmac.compare_digest(expected, provided)
-    return provided_secret == secret
+        expected = hmac.new(secret, body, hashlib.sha256).digest()
+        provided = signature_header.removeprefix("sha256=")
+        try:
+            provided_digest = bytes.fromhex(provided)
+        except ValueError:
+            return False
+        return hmac.compare_digest(expected, provided_digest)
+    if provided_secret is None:
+        return False
+    return hmac.compare_digest(provided_secret.encode("utf-8"), secret)
 
 
 def _as_list(payload: dict[str, Any]) -> Iterable[dict[str, Any]]:
@@ -43,62 +47,64 @@ def _as_list(payload: dict[str, Any]) -> Iterable[dict[str, Any]]:
     return []
 
 
+_FROM_ME_KEYS = ("from_me", "fromMe")
+_SELF_SENDERS = frozenset({"me", "self"})
+_STATUS_TYPES = frozenset({"status", "story"})
+_PHOTO_TYPES = frozenset({"image", "photo"})
+_VIDEO_TYPES = frozenset({"video", "video/mp4"})
+
+
 def _is_from_me(message: dict[str, Any]) -> bool:
-    for key in ("from_me", "fromMe", "from_me"):
+    for key in _FROM_ME_KEYS:
         if key in message:
-            return bool(message.get(key))
+            return bool(message[key])
     sender = message.get("from") or message.get("author")
-    if isinstance(sender, str) and sender.lower() in {"me", "self"}:
-        return True
-    return False
+    return isinstance(sender, str) and sender.lower() in _SELF_SENDERS
 
 
 def _is_status(message: dict[str, Any]) -> bool:
-    if message.get("type") in {"status", "story"}:
-        return True
-    if message.get("chat_type") in {"status", "story"}:
-        return True
-    if message.get("is_status") or message.get("isStatus"):
-        return True
-    return False
+    return (
+        message.get("type") in _STATUS_TYPES
+        or message.get("chat_type") in _STATUS_TYPES
+        or bool(message.get("is_status") or message.get("isStatus"))
+    )
+
+
+def _media_ref(media: dict[str, Any]) -> tuple[Optional[str], Optional[str]]:
+    return media.get("id") or media.get("media_id"), media.get("url") or media.get("link")
 
 
 def _extract_media(message: dict[str, Any]) -> tuple[Optional[str], Optional[str], str]:
+    image = message.get("image")
+    video = message.get("video")
+    image = image if isinstance(image, dict) else None
+    video = video if isinstance(video, dict) else None
     media = message.get("media") or message.get("file") or message.get("data")
     media_id = None
     media_url = None
     if isinstance(media, dict):
-        media_id = media.get("id") or media.get("media_id")
-        media_url = media.get("url") or media.get("link")
-    if not media and isinstance(message.get("image"), dict):
-        media = message["image"]
-        media_id = media.get("id") or media.get("media_id")
-        media_url = media.get("url") or media.get("link")
-    if not media and isinstance(message.get("video"), dict):
-        media = message["video"]
-        media_id = media.get("id") or media.get("media_id")
-        media_url = media.get("url") or media.get("link")
+        media_id, media_url = _media_ref(media)
+    if not media:
+        fallback = image or video
+        if fallback:
+            media_id, media_url = _media_ref(fallback)
+    if video is not None:
+        return media_id, media_url, "video"
+    if image is not None:
+        return media_id, media_url, "photo"
     media_type = message.get("type") or message.get("media_type") or "unknown"
-    if isinstance(message.get("image"), dict):
-        media_type = "photo"
-    if isinstance(message.get("video"), dict):
-        media_type = "video"
-    if media_type in {"image", "photo"}:
-        media_type = "photo"
-    elif media_type in {"video", "video/mp4"}:
-        media_type = "video"
-    else:
-        media_type = "unknown"
-    return media_id, media_url, media_type
+    if media_type in _PHOTO_TYPES:
+        return media_id, media_url, "photo"
+    if media_type in _VIDEO_TYPES:
+        return media_id, media_url, "video"
+    return media_id, media_url, "unknown"
 
 
 def extract_status_events(payload: dict[str, Any]) -> list[WebhookStatusEvent]:
     events: list[WebhookStatusEvent] = []
     whapi_event_id = payload.get("event_id") or payload.get("id")
     for message in _as_list(payload):
-        if not _is_from_me(message):
-            continue
-        if not _is_status(message):
+        if not _is_from_me(message) or not _is_status(message):
             continue
         media_id, media_url, media_type = _extract_media(message)
         if media_type == "unknown":
@@ -1,10 +1,15 @@
 from __future__ import annotations
 
-import json
+import hashlib
 from pathlib import Path
 from typing import Any, Optional
 
+import aiofiles
 import httpx
+import orjson
+
+_DOWNLOAD_CHUNK_SIZE = 1 << 20
+_JSON_HEADERS = {"Content-Type": "application/json"}
 
 
 class WhapiError(RuntimeError):
@@ -20,51 +25,74 @@ def _extract_media_id(payload: dict[str, Any]) -> Optional[str]:
     return payload.get("id") or payload.get("media_id")
 
 
+async def _write_stream(response: httpx.Response, dest: Path, digest: Optional[hashlib._Hash]) -> None:
+    async with aiofiles.open(dest, "wb", buffering=_DOWNLOAD_CHUNK_SIZE) as handle:
+        async for chunk in response.aiter_bytes(chunk_size=_DOWNLOAD_CHUNK_SIZE):
+            if digest is not None:
+                digest.update(chunk)
+            await handle.write(chunk)
+
+
 class WhapiClient:
     def __init__(self, base_url: str, token: str) -> None:
         self.base_url = base_url.rstrip("/")
         self.token = token
+        self._client = httpx.AsyncClient(
+            base_url=self.base_url,
+            headers={"Authorization": f"Bearer {token}"},
+            timeout=60,
+            http2=True,
+            limits=httpx.Limits(max_keepalive_connections=20, max_connections=40),
+        )
 
-    def _headers(self) -> dict[str, str]:
-        return {"Authorization": f"Bearer {self.token}"}
+    async def aclose(self) -> None:
+        await self._client.aclose()
 
-    async def download_media(self, *, media_url: Optional[str], media_id: Optional[str]) -> tuple[bytes, str]:
+    async def download_media(
+        self,
+        *,
+        media_url: Optional[str],
+        media_id: Optional[str],
+        dest: Path,
+        digest: Optional[hashlib._Hash] = None,
+    ) -> str:
         if not media_url and not media_id:
             raise WhapiError("Missing media reference")
         url = media_url
         if not url:
-            url = f"{self.base_url}/media/{media_id}/download"
-        async with httpx.AsyncClient(timeout=60) as client:
-            response = await client.get(url, headers=self._headers())
+            url = f"/media/{media_id}/download"
+        async with self._client.stream("GET", url) as response:
             if response.status_code >= 400:
                 raise WhapiError(f"Media download failed: {response.status_code}")
             content_type = response.headers.get("content-type", "application/octet-stream")
-            if content_type.startswith("application/json") and not media_url and media_id:
-                data = response.json()
-                resolved_url = data.get("url") or data.get("link")
-                if resolved_url:
-                    follow = await client.get(resolved_url, headers=self._headers())
-                    if follow.status_code >= 400:
-                        raise WhapiError(f"Media download failed: {follow.status_code}")
-                    content_type = follow.headers.get("content-type", "application/octet-stream")
-                    return follow.content, content_type
-            return response.content, content_type
+            if not (content_type.startswith("application/json") and not media_url and media_id):
+                await _write_stream(response, dest, digest)
+                return content_type
+            body = await response.aread()
+        data = orjson.loads(body)
+        resolved_url = data.get("url") or data.get("link")
+        if not resolved_url:
+            if digest is not None:
+                digest.update(body)
+            async with aiofiles.open(dest, "wb") as handle:
+                await handle.write(body)
+            return content_type
+        async with self._client.stream("GET", resolved_url) as follow:
+            if follow.status_code >= 400:
+                raise WhapiError(f"Media download failed: {follow.status_code}")
+            await _write_stream(follow, dest, digest)
+            return follow.headers.get("content-type", "application/octet-stream")
 
     async def upload_media(self, file_path: Path) -> str:
-        async with httpx.AsyncClient(timeout=60) as client:
-            with file_path.open("rb") as handle:
-                response = await client.post(
-                    f"{self.base_url}/media",
-                    headers=self._headers(),
-                    files={"file": handle},
-                )
-            if response.status_code >= 400:
-                raise WhapiError(f"Media upload failed: {response.status_code}")
-            payload = response.json()
-            media_id = _extract_media_id(payload)
-            if not media_id:
-                raise WhapiError("Media upload returned no media id")
-            return media_id
+        with file_path.open("rb") as handle:
+            response = await self._client.post("/media", files={"file": handle})
+        if response.status_code >= 400:
+            raise WhapiError(f"Media upload failed: {response.status_code}")
+        payload = orjson.loads(response.content)
+        media_id = _extract_media_id(payload)
+        if not media_id:
+            raise WhapiError("Media upload returned no media id")
+        return media_id
 
     async def post_status(self, *, media_id: str, media_type: str, caption: Optional[str]) -> str:
         payload: dict[str, Any] = {
@@ -73,14 +101,13 @@ class WhapiClient:
         }
         if caption:
             payload["caption"] = caption
-        async with httpx.AsyncClient(timeout=60) as client:
-            response = await client.post(
-                f"{self.base_url}/messages/status",
-                headers={**self._headers(), "Content-Type": "application/json"},
-                content=json.dumps(payload),
-            )
+        response = await self._client.post(
+            "/messages/status",
+            headers=_JSON_HEADERS,
+            content=orjson.dumps(payload),
+        )
         if response.status_code >= 400:
             raise WhapiError(f"Status post failed: {response.status_code}")
-        data = response.json()
+        data = orjson.loads(response.content)
         status_id = data.get("id") or data.get("message_id") or data.get("status_id")
         return str(status_id) if status_id else ""
@@ -2,44 +2,113 @@ from __future__ import annotations
 
 import asyncio
 import logging
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
 from typing import Optional
 
 from app import db
-from app.processor import process_event
+from app.processor import ensure_storage_dirs, process_event, prune_prepared_cache, warm_up_encoder
 from app.settings import Settings, get_settings
+from app.whapi_client import WhapiClient
 
 logger = logging.getLogger(__name__)
 
+_CACHE_PRUNE_INTERVAL_S = 3600
+
 
 class Worker:
     def __init__(self, settings: Settings) -> None:
         self.settings = settings
         self._task: Optional[asyncio.Task] = None
+        self._warmup_task: Optional[asyncio.Task] = None
         self._stop_event = asyncio.Event()
+        self.wakeup = asyncio.Event()
+        self.source_client = WhapiClient(settings.whapi_api_url, settings.whapi_source_token)
+        self.target_client = WhapiClient(settings.whapi_api_url, settings.whapi_target_token)
+        self._executor = ProcessPoolExecutor(
+            max_workers=settings.worker_concurrency,
+            mp_context=multiprocessing.get_context("forkserver"),
+        )
+        self._next_cache_prune = 0.0
 
     async def start(self) -> None:
         if self._task:
             return
+        ensure_storage_dirs(self.settings)
+        self._warmup_task = asyncio.create_task(warm_up_encoder(self.settings))
         self._task = asyncio.create_task(self.run())
 
     async def stop(self) -> None:
         self._stop_event.set()
-        if self._task:
-            await self._task
+        self.wakeup.set()
+        try:
+            if self._warmup_task:
+                await self._warmup_task
+            if self._task:
+                await self._task
+        finally:
+            await self.source_client.aclose()
+            await self.target_client.aclose()
+            self._executor.shutdown(cancel_futures=True)
+
+    async def _wait_for_progress(self, running: set[asyncio.Task]) -> None:
+        waiters: set[asyncio.Future] = set(running)
+        wakeup: Optional[asyncio.Task] = None
+        timeout: Optional[float] = None
+        if len(running) < self.settings.worker_concurrency:
+            wakeup = asyncio.create_task(self.wakeup.wait())
+            waiters.add(wakeup)
+            timeout = self.settings.poll_interval_s
+        try:
+            await asyncio.wait(waiters, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            if wakeup is not None:
+                wakeup.cancel()
+        self.wakeup.clear()
+
+    async def _prune_cache_if_due(self) -> None:
+        now = time.monotonic()
+        if now < self._next_cache_prune:
+            return
+        self._next_cache_prune = now + _CACHE_PRUNE_INTERVAL_S
+        await prune_prepared_cache(self.settings)
+
+    async def _process(self, event: db.InboundStatusEvent) -> None:
+        logger.info("worker.processing", extra={"event_id": event.id})
+        await process_event(
+            self.settings,
+            event,
+            source_client=self.source_client,
+            target_client=self.target_client,
+            executor=self._executor,
+        )
 
     async def run(self) -> None:
         logger.info("worker.started")
-        while not self._stop_event.is_set():
-            event = await db.fetch_next_event(
-                self.settings.db_path,
-                now=db.utc_now(),
-                max_attempts=self.settings.max_attempts,
-            )
-            if not event:
-                await asyncio.sleep(self.settings.poll_interval_s)
-                continue
-            logger.info("worker.processing", extra={"event_id": event.id})
-            await process_event(self.settings, event)
+        running: set[asyncio.Task] = set()
+        try:
+            while not self._stop_event.is_set():
+                for task in [task for task in running if task.done()]:
+                    running.discard(task)
+                    task.result()
+                await self._prune_cache_if_due()
+                free_slots = self.settings.worker_concurrency - len(running)
+                if free_slots > 0:
+                    limit = min(free_slots, self.settings.fetch_batch_size)
+                    events = await db.fetch_next_events(
+                        self.settings.db_path,
+                        now=db.utc_now(),
+                        max_attempts=self.settings.max_attempts,
+                        limit=limit,
+                    )
+                    running.update(asyncio.create_task(self._process(event)) for event in events)
+                    if len(events) == limit and len(running) < self.settings.worker_concurrency:
+                        continue
+                await self._wait_for_progress(running)
+        finally:
+            if running:
+                await asyncio.gather(*running, return_exceptions=True)
 
 
 def main() -> None:
@@ -47,14 +116,17 @@ def main() -> None:
     logging.basicConfig(level=settings.log_level)
 
     async def runner() -> None:
-        await db.init_db(settings.db_path)
-        worker = Worker(settings)
-        await worker.start()
         try:
-            while True:
-                await asyncio.sleep(3600)
-        except KeyboardInterrupt:
-            await worker.stop()
+            await db.init_db(settings.db_path)
+            worker = Worker(settings)
+            await worker.start()
+            try:
+                while True:
+                    await asyncio.sleep(3600)
+            finally:
+                await worker.stop()
+        finally:
+            await db.close_db()
 
     asyncio.run(runner())
 